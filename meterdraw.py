@@ -11,13 +11,9 @@
 # Meterdraw v0.85 ************************************************************ #
 
 import sys
-import argparse
 import math
 import re
-
-from font import getfont
-
-from writepng import encode_png
+import time
 
 
 version = 0.85
@@ -30,45 +26,168 @@ Meterdraw creates scale cards for analog meter movements.
 u_epilogue = "See README.md for more information."
 
 def main():
+    import argparse
     argp = argparse.ArgumentParser(
         description=u_description, epilog=u_epilogue,
         formatter_class=argparse.RawDescriptionHelpFormatter)
     argroup = argp.add_mutually_exclusive_group(required=True)
-    argroup.add_argument("-f", dest="source_filename", metavar="designfile", help="file to read design instructions from")
+    argroup.add_argument("-f", dest="source_filenames", metavar="designfile", action="append", help="file to read design instructions from, may be repeated with -s")
     argroup.add_argument("-x", dest="script", metavar="instructions", help="string to process as design instructions")
-    argp.add_argument("out_filename", metavar="outputfile", help="filename for output image (should end .png)")
+    argp.add_argument("-a", dest="antialias", metavar="level", choices=Canvas.antialias_levels, help="anti-aliasing level: none, standard or proof")
+    argp.add_argument("-m", dest="mapfile", metavar="mapfile", help="keep the image in a memory mapped file (- for a temporary file)")
+    argp.add_argument("-o", dest="format", metavar="format", choices=Canvas.output_formats, help="output format: png, ppm, pgm, tiff or tiff-packbits")
+    argp.add_argument("-v", dest="viewport", metavar=("x", "y", "width", "height"), type=float, nargs=4, help="draw only this window of the card, in mm from its top left corner")
+    argp.add_argument("-z", dest="zoom", metavar="factor", type=float, default=1, help="magnify the design resolution by this factor")
+    argp.add_argument("-b", dest="base_filename", metavar="basefile", help="file of instructions shared by the design files, drawn beneath each of them")
+    argp.add_argument("-s", dest="sheet", metavar="sheetinstructions", help="impose the design files onto one sheet")
+    argp.add_argument("-j", dest="jobs", metavar="jobs", type=int, default=1, help="number of cards to draw in parallel with -s, or bands with -p")
+    argp.add_argument("-p", dest="pipeline", action="store_true", help="draw in bands while compressing and writing in parallel")
+    argp.add_argument("-c", "--check", action="store_true", help="check the design instructions without drawing")
+    argp.add_argument("-e", "--estimate", action="store_true", help="predict the size, memory and time needed without drawing")
+    argp.add_argument("--verify", metavar="backend", choices=[b for b in backends if b != "reference"], help="compare drawing with a backend against the reference, for each design file")
+    argp.add_argument("--tolerance", metavar="n", type=int, default=0, help="largest pixel value difference allowed by --verify")
+    argp.add_argument("-t", dest="time_limit", metavar="seconds", type=float, help="stop drawing after this many seconds")
+    argp.add_argument("--max-pixels", metavar="n", type=int, help="refuse images with more pixels than this")
+    argp.add_argument("--max-memory", metavar="MB", type=float, help="refuse images needing more memory than this")
+    argp.add_argument("out_filename", metavar="outputfile", nargs="?", help="filename for output image (.png, .ppm, .pgm or .tif)")
 
     args = argp.parse_args()
-
+    if args.out_filename is None and not (args.check or args.estimate or args.verify):
+        argp.error("the following arguments are required: outputfile")
+    if args.estimate and args.sheet is not None:
+        argp.error("cannot estimate a sheet (-s)")
+    if (args.viewport or args.zoom != 1) and args.sheet is not None:
+        argp.error("cannot draw a window of a sheet (-s)")
+    if args.zoom <= 0:
+        argp.error("zoom factor must be positive")
+    if args.source_filenames and len(args.source_filenames) > 1 and args.sheet is None and not args.verify:
+        argp.error("more than one design file needs a sheet (-s)")
+    if args.verify and args.sheet is not None:
+        argp.error("cannot verify a sheet (-s)")
+
+    scripts = [args.script]
+    base = None
     if args.script is None:
         try:
-            with open(args.source_filename, 'r') as f:
-                args.script = f.read()
+            scripts = []
+            for filename in args.source_filenames:
+                with open(filename, 'r') as f:
+                    scripts.append(f.read())
         except:
             print("Error reading file")
-            sys.exit()
-
-    c = Canvas()
-
-    a, success = parse(args.script, c)
-
-    print(a)
+            sys.exit(1)
+    if args.base_filename is not None:
+        try:
+            with open(args.base_filename, 'r') as f:
+                base = f.read()
+        except:
+            print("Error reading file")
+            sys.exit(1)
+
+    backing = True if args.mapfile == "-" else args.mapfile
+    max_memory = None if args.max_memory is None else int(args.max_memory * 2 ** 20)
+    limits = dict(max_pixels=args.max_pixels, max_memory=max_memory, time_limit=args.time_limit)
+    window = dict(viewport=args.viewport and tuple(args.viewport), zoom=args.zoom)
+
+    if args.verify:
+        success = True
+        for name, script in zip(args.source_filenames or ["instructions"], scripts):
+            a, r = verify(script, args.verify, args.antialias, base)
+            if r is None:
+                print(f"{name}: {a}")
+                success = False
+                continue
+            largest, mean, count, regions, speedup = r
+            print(f"{name}: largest difference {largest}, mean {mean:.4f}, "
+                f"{count} pixels differ, {speedup:.2f} times the speed of reference")
+            for x, y, w, h in regions:
+                print(f"  differences within {w} x {h} pixels at {x}, {y}")
+            if largest > args.tolerance: success = False
+        sys.exit(0 if success else 1)
+
+    if args.estimate:
+        c = EstimateCanvas(antialias=args.antialias, backing=backing,
+            max_pixels=args.max_pixels, max_memory=max_memory, **window)
+        a, e = estimate(scripts[0], c, base)
+        if e is None:
+            print(a)
+            sys.exit(1)
+        pixels, candidates, memory, seconds = e
+        print(f"image of {c.actual_width} x {c.actual_height} pixels")
+        print(f"{candidates} pixels to consider drawing")
+        print(f"peak memory {memory / 2 ** 20:.1f} MB")
+        print(f"about {seconds:.1f} seconds")
+        success = True
+        if max_memory is not None and memory > max_memory:
+            print("predicted memory exceeds limit")
+            success = False
+        if args.time_limit is not None and seconds > args.time_limit:
+            print("predicted time exceeds limit")
+            success = False
+        sys.exit(0 if success else 1)
+
+    if args.sheet is not None and args.check:
+        a, success = parse_sheet(args.sheet, Sheet())
+        print(a)
+        for name, script in zip(args.source_filenames or ["instructions"], scripts):
+            a, ok = parse(script, CheckCanvas(), base=base)
+            print(f"{name}: {a}")
+            success = success and ok
+        sys.exit(0 if success else 1)
+    elif args.sheet is not None:
+        c = Sheet(antialias=args.antialias, backing=backing, **limits)
+        names = args.source_filenames or ["instructions"]
+        success = impose(c, args.sheet, scripts, names, args.jobs, base, limits)
+    else:
+        c = CheckCanvas(**window) if args.check else Canvas(antialias=args.antialias,
+            backing=backing, pipeline=args.pipeline,
+            jobs=args.jobs if args.pipeline else 1, **limits, **window)
+
+        a, success = parse(scripts[0], c, base=base)
+
+        print(a)
+
+        if args.check:
+            sys.exit(0 if success else 1)
 
     if success:
         try:
             print(f"Saving to {args.out_filename}")
-            c.save(args.out_filename)
+            c.save(args.out_filename, args.format)
+        except CommandException as e:
+            # drawing deferred to saving, or the credit line, can hit the limits
+            print(f"Error drawing image: {e}")
+            sys.exit(1)
         except:
             print("Error writing file")
-            sys.exit()
-
-
-def parse(string, plate):
+            sys.exit(1)
+        finally:
+            c.close()
+    else:
+        sys.exit(1)
+
+
+def parse(string, plate, interpreter=None, base=None):
+    c = (interpreter or CommandInterpreter)(plate)
+    if base is not None:
+        a, c = base_layer(base, plate)
+        if c is None: return a, False
+    return interpret(string, c)
+
+def estimate(script, plate, base=None):
+    # predict the cost of drawing a design on an EstimateCanvas, counting
+    # its base layer as well, as it is drawn for the first card sharing it
+    c = CommandInterpreter(plate)
+    for s in ([] if base is None else [base]) + [script]:
+        a, success = interpret(s, c)
+        if not success: return a, None
+    return a, plate.estimate()
+
+def interpret(string, interpreter):
     tokens = tokeniser(string)
-    r = parser(tokens, plate.units)
+    r = parser(tokens, interpreter.plate.units)
     if type(r) is not tuple:
-        c = CommandInterpreter(plate)
-        r = c.docommands(r)
+        r = interpreter.docommands(r)
     if type(r) is tuple:
         error = f"{r[0]} on line {r[1]} at\n"
         error += " " * r[3] + "\\/\n"
@@ -76,19 +195,62 @@ def parse(string, plate):
         return error, False
     return r, True
 
+layer_cache = {}
+layer_cache_size = 4  # base layers kept, each holding a whole image
+
+def base_layer(base, plate):
+    # interpreter carrying on from a base layer of instructions shared by many
+    # designs, with the plate starting from the base layer's pixels; each base
+    # layer is drawn once for each plate configuration and then reused
+    kind = CheckCanvas if isinstance(plate, CheckCanvas) else Canvas
+    key = (base, kind, plate.forced_resolution, plate.forced_bleed, plate.forced_antialias,
+        plate.viewport, plate.zoom, plate.max_pixels, plate.max_memory, plate.time_limit,
+        bool(plate.backing))
+    if key in layer_cache:
+        layer_cache[key] = layer_cache.pop(key)  # most recently used last
+    else:
+        while len(layer_cache) >= layer_cache_size:
+            clear_layers(next(iter(layer_cache)))
+        # a memory mapped plate gets a base layer in a temporary mapped file
+        c = CommandInterpreter(kind(antialias=plate.forced_antialias,
+            resolution=plate.forced_resolution, bleed=plate.forced_bleed,
+            viewport=plate.viewport, zoom=plate.zoom, backing=bool(plate.backing) or None,
+            max_pixels=plate.max_pixels, max_memory=plate.max_memory))
+        c.plate.deadline = plate.deadline  # drawing the base counts against the plate's time
+        a, success = interpret(base, c)
+        if not success:
+            c.plate.close()
+            layer_cache[key] = (f"base layer: {a}", None, None)
+        else:
+            canvas, c.plate = c.plate, None
+            layer_cache[key] = (a, c, canvas)
+    a, layer, canvas = layer_cache[key]
+    if layer is None: return a, None
+    try:
+        return a, layer.carry_on(plate, canvas.pixels)
+    except CommandException as e:
+        return str(e), None
+
+def clear_layers(*keys):
+    # drop cached base layers, or all of them, closing their canvases
+    for key in keys or list(layer_cache):
+        a, layer, canvas = layer_cache.pop(key)
+        if canvas: canvas.close()
+
+token_spec = [
+    ("comment", r"#([^\012-\015])*"),
+    ("number", r"-?(\d+(\.\d+)?|\.\d+)"),
+    ("word", r"[^\01-\040\d\.`]+"),
+    ("percent", r"%"),
+    ("string", r"`([^`\01-\010\012-\037]|`[a-zA-Z`\.\-~=])*`"),
+    ("newline", r"\015\012|[\012-\015]"),
+    ("space", r"[\01-\011\016-\040]+"),
+    ("other", r"."),
+]
+token_rx = re.compile("|".join(f"(?P<{s[0]}>{s[1]})" for s in token_spec))
+
 def tokeniser(string):
-    spec = [
-        ("comment", r"#([^\012-\015])*"),
-        ("number", r"-?(\d+(\.\d+)?|\.\d+)"),
-        ("word", r"[^\01-\040\d\.`]+"),
-        ("percent", r"%"),
-        ("string", r"`([^`\01-\010\012-\037]|`[a-zA-Z`\.\-~=])*`"),
-        ("newline", r"\015\012|[\012-\015]"),
-        ("space", r"[\01-\011\016-\040]+"),
-        ("other", r"."),
-    ]
-    rx = "|".join(f"(?P<{s[0]}>{s[1]})" for s in spec)
-    tokens = [(m.lastgroup, m.group(), m.start(), m.end()) for m in re.finditer(rx, string)]
+    tokens = [(m.lastgroup, m.group(), m.start(), m.end()) for m in token_rx.finditer(string)]
     r = []
     line, col, linestart = 1, 0, 0
     for t in tokens:
@@ -125,6 +287,49 @@ def string_escape(string):
         q += c
     return q
 
+def scale_steps(start, stop, step):
+    if step <= 0 or stop <= start:
+        raise CommandException("invalid scale range")
+    n = int((stop - start) / step + 1e-9)
+    return [round(start + i * step, 9) for i in range(0, n + 1)]
+
+def linear_scale(start, stop, step):
+    values = scale_steps(start, stop, step)
+    return values, [(v - start) * 100 / (stop - start) for v in values]
+
+def log_scale(start, stop, step=1):
+    if start <= 0: raise CommandException("log scale must start above zero")
+    if stop <= start or step <= 0 or step >= 10:
+        raise CommandException("invalid scale range")
+    values = []
+    decade = 10 ** math.floor(math.log10(start))
+    while decade <= stop:
+        for m in scale_steps(1, 10 - step / 2, step):
+            v = round(m * decade, 9)
+            if start <= v <= stop * (1 + 1e-9): values.append(v)
+        decade *= 10
+    span = math.log10(stop / start)
+    return values, [math.log10(v / start) * 100 / span for v in values]
+
+def db_scale(start, stop, step):
+    # decibels of voltage, with stop at full scale
+    values = scale_steps(start, stop, step)
+    return values, [10 ** ((v - stop) / 20) * 100 for v in values]
+
+def table_scale(table, start, stop, step):
+    # piecewise linear interpolation between (value, percent) calibration points
+    table = sorted(table)
+    values = scale_steps(start, stop, step)
+    r = []
+    for v in values:
+        if v < table[0][0] or v > table[-1][0]:
+            raise CommandException(f"value {v:g} outside calibration table")
+        for i in range(1, len(table)):
+            if v <= table[i][0]: break
+        (v0, p0), (v1, p1) = table[i-1], table[i]
+        r.append(p0 + (p1 - p0) * (v - v0) / (v1 - v0) if v1 != v0 else p1)
+    return values, r
+
 def parser(tokens, units):
     def get_arg():
         if not len(tokens): return False, False
@@ -170,12 +375,15 @@ class CommandInterpreter():
         self.plate_height = False
         self.plate_resolution = False
         self.plate_box = False
+        self.plate_antialias = "standard"
         #
         self.stroke = 0
         self.pivot_x, self.pivot_y = False, False
         self.center_x, self.center_y = False, False
         self.span, self.offset = 0, 0
         self.angles = []
+        self.values = None
+        self.calibration = []
         self.monospace = False
         self.align = "c"
         self.size = 0
@@ -186,6 +394,7 @@ class CommandInterpreter():
         for i, c in enumerate(commands):
             try:
                 self.docommand(c)
+                self.plate.check_deadline()
                 q = int((i+1) * 78 / len(commands))
                 if p < q:
                     print("." * (q - p), end="", flush=True)
@@ -219,6 +428,12 @@ class CommandInterpreter():
             self.plate_box = c[1]
             return
 
+        elif word in ("antialias-none", "antialias-standard", "antialias-proof"):
+            if self.is_setup: self.exception("cannot reset anti-aliasing")
+            self.countargs(0)
+            self.plate_antialias = word[10:]
+            return
+
         # set up canvas before executing drawing commands
         if not self.is_setup:
             self.call_setup()
@@ -291,7 +506,7 @@ class CommandInterpreter():
             set_angles = False
             for i in range(3, len(c)):
                 if not set_angles:
-                    self.angles = []
+                    self.angles, self.values = [], None
                     set_angles = True
                 self.angles.append(self.o(c[i]))
             if not self.angles: self.exception("no angles given for marks")
@@ -302,7 +517,7 @@ class CommandInterpreter():
                 self.angles, self.stroke)
 
         elif word == "label":
-            self.minimumargs(2)
+            self.minimumargs(1)
             radius = self.u(c[1])
             set_angles = False
             labels = []
@@ -311,9 +526,11 @@ class CommandInterpreter():
                     labels.append(self.s(c[i]))
                 else:
                     if not set_angles:
-                        self.angles = []
+                        self.angles, self.values = [], None
                         set_angles = True
                     self.angles.append(self.o(c[i]))
+            if not labels and self.values is not None:
+                labels = [f"{v:g}" for v in self.values]
             if not labels: self.exception("label requires text string(s)")
             if not self.angles: self.exception("no angles given for labels")
             px = self.pivot_x if self.pivot_x is not False else self.center_x
@@ -322,10 +539,33 @@ class CommandInterpreter():
                 radius, self.span, self.offset,
                 self.angles, labels, self.size)
 
+        elif word == "scale-linear":
+            self.countargs(3)
+            self.values, self.angles = linear_scale(*(self.o(a) for a in c[1:]))
+
+        elif word == "scale-log":
+            self.countargs(2,3)
+            self.values, self.angles = log_scale(*(self.o(a) for a in c[1:]))
+
+        elif word == "scale-db":
+            self.countargs(3)
+            self.values, self.angles = db_scale(*(self.o(a) for a in c[1:]))
+
+        elif word == "calibrate":
+            self.minimumargs(4)
+            if len(c) % 2 == 0: self.exception("calibration needs value and percent pairs")
+            self.calibration = [(self.o(c[i]), self.o(c[i+1])) for i in range(1, len(c), 2)]
+
+        elif word == "scale-table":
+            self.countargs(3)
+            if not self.calibration: self.exception("no calibration table given")
+            self.values, self.angles = table_scale(self.calibration,
+                *(self.o(a) for a in c[1:]))
+
         else:
             self.exception(f"unknown command {word}")
 
-    def call_setup(self):
+    def call_setup(self, layer=None):
         r = self.plate_resolution[0] if self.plate_resolution else 300
         ru = self.plate_resolution[1] if self.plate_resolution else "dpi"
         w = self.plate_width[0] if self.plate_width else 10
@@ -336,10 +576,21 @@ class CommandInterpreter():
         bu = self.plate_box[1] if self.plate_box else "pt"
         self.plate.setup(resolution=r, resolution_units=ru,
             width=w, width_units=wu, height=h, height_units=hu,
-            box=b, box_units=bu)
+            box=b, box_units=bu, antialias=self.plate_antialias, layer=layer)
         self.stroke = self.plate.topixels(1, "pt")
         self.size = self.plate.topixels(12, "pt")
 
+    def carry_on(self, plate, pixels):
+        # copy of this interpreter drawing onto another plate, which is set up
+        # the same way and starts from the given pixels
+        import copy
+        c = copy.copy(self)
+        c.plate = plate
+        if c.is_setup:
+            c.call_setup(pixels)
+            c.stroke, c.size = self.stroke, self.size
+        return c
+
     def countargs(self, *argc):
         if len(self.command) - 1 not in argc:
             raise CommandException(f"wrong number of arguments")
@@ -369,47 +620,212 @@ class CommandInterpreter():
 
 
 class Canvas():
-    def __init__(self):
+    def __init__(self, antialias=None, backing=None, resolution=None, bleed=None, pipeline=False,
+            max_pixels=None, max_memory=None, time_limit=None, viewport=None, zoom=1, jobs=1):
         self.resolution = 1
         self.feather = 1.5
-        self.planes = False
+        self.forced_antialias = antialias
+        self.forced_resolution = resolution  # dpi, overriding the design
+        self.forced_bleed = bleed  # mm, for cards placed on a sheet without crop marks
+        self.antialias = antialias or "standard"
+        self.backing = backing  # None, True for a temporary file, or a filename
+        self.backing_file = None
+        self.pipeline = pipeline  # draw in bands at save time, overlapping compression
+        self.jobs = jobs  # number of bands to draw in parallel when pipelined
+        self.viewport = viewport  # (x, y, width, height) in mm, to draw only that window
+        self.zoom = zoom  # magnification of the design resolution
+        self.display_list = None
+        self.max_pixels = max_pixels  # limit on image width times height
+        self.max_memory = max_memory  # limit on bytes of image held in memory
+        self.time_limit = time_limit  # seconds allowed for drawing, from now
+        self.deadline = None if time_limit is None else time.monotonic() + time_limit
+        self.pixels = False
 
     def setup(self, resolution=300, resolution_units="dpi",
             width=10, width_units="cm", height=5, height_units="cm",
-            box=0, box_units="pt"):
+            box=0, box_units="pt", antialias="standard", layer=None):
         bleed = 1
         bleed_units = "in"
-        self.resolution = self.topixels(resolution, resolution_units)
+        if self.forced_resolution:
+            resolution, resolution_units = self.forced_resolution, "dpi"
+        if self.forced_bleed is not None:
+            bleed, bleed_units = self.forced_bleed, "mm"
+        self.antialias = self.forced_antialias or antialias
+        self.resolution = self.topixels(resolution, resolution_units) * self.zoom
         self.bleed_box = self.topixels(box, box_units)
         self.bleed_size = int(self.topixels(bleed, bleed_units) + 0.5)
         self.width = int(self.topixels(width, width_units) + 0.5)
         self.height = int(self.topixels(height, height_units) + 0.5)
         self.max_x = self.width + self.bleed_size
         self.max_y = self.height + self.bleed_size
-        w, h = self.width + self.bleed_size * 2, self.height + self.bleed_size * 2
+        self.clip = (-self.bleed_size, -self.bleed_size, self.max_x, self.max_y)
+        if self.viewport:
+            self.clip = self.viewport_clip()
+        # position of the card's top left corner in the image
+        self.origin_x, self.origin_y = -self.clip[0], -self.clip[1]
+        w, h = self.clip[2] - self.clip[0], self.clip[3] - self.clip[1]
         self.actual_width = w
-        size = w * h
-        self.setup_planes(size, (255,255,255))
+        self.actual_height = h
+        self.check_limits(w, h)
+        self.setup_pixels(w, h, (255,255,255))
+        if self.pipeline: self.display_list = []
         #
         self.stroke = 10
         #
-        self.setup_bleed()
-
-    def setup_planes(self, size, x):
-        self.planes = (bytearray(size), bytearray(size), bytearray(size))
-        for i in range(0, len(self.planes[0])):
-            self.planes[0][i], self.planes[1][i], self.planes[2][i] = x
+        if layer is None:
+            self.setup_bleed()
+        elif self.pixels:
+            # start from a copy of a base layer's pixels instead of a blank card
+            self.pixels[:] = layer
+
+    def viewport_clip(self):
+        # pixels covered by the viewport, within the bleed around the card
+        x, y, w, h = (self.topixels(v, "mm") for v in self.viewport)
+        x0, y0, x1, y1 = self.clip
+        clip = (max(x0, math.floor(x)), max(y0, math.floor(y)),
+            min(x1, math.ceil(x + w)), min(y1, math.ceil(y + h)))
+        if clip[0] >= clip[2] or clip[1] >= clip[3]:
+            raise CommandException("viewport is outside the image")
+        return clip
+
+    def check_limits(self, w, h):
+        # refuse images larger than the limits before allocating them
+        if self.max_pixels is not None and w * h > self.max_pixels:
+            raise CommandException(f"image of {w} x {h} pixels exceeds pixel limit")
+        if self.max_memory is not None and not self.backing and (w * 3 + 1) * h > self.max_memory:
+            raise CommandException(f"image of {w} x {h} pixels exceeds memory limit")
+
+    def check_deadline(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise CommandException("time limit exceeded")
+
+    def setup_pixels(self, w, h, x):
+        # pixels are stored as png scanlines, each a filter byte then rgb values
+        self.stride = w * 3 + 1
+        row = bytes(1) + bytes(x) * w
+        if not self.backing:
+            self.pixels = bytearray(row) * h
+            return
+        # keep the pixels in a memory mapped file, so the os can page them
+        import mmap
+        if self.backing is True:
+            import tempfile
+            self.backing_file = tempfile.TemporaryFile()
+        else:
+            self.backing_file = open(self.backing, "w+b")
+        self.backing_file.truncate(self.stride * h)
+        self.pixels = mmap.mmap(self.backing_file.fileno(), self.stride * h)
+        for y in range(0, h):
+            self.pixels[y*self.stride:(y+1)*self.stride] = row
+
+    def close(self):
+        if self.backing_file:
+            self.pixels.close()
+            self.backing_file.close()
+            self.backing_file = None
+        self.pixels = False
+
+    def __buffer__(self, flags):
+        return memoryview(self.pixels)
 
     units =     ("mm", "cm", "in", "inch", "pt",  "pc",  "dpi", "dpcm",   "%")
     unit_values = (1.0, 10,  25.4,  25.4,  0.352778, 4.23333, 1/25.4, 1/10, 1.0)
 
-    def save(self, filename):
-        if not self.planes: return
+    output_formats = ("png", "ppm", "pgm", "tiff", "tiff-packbits")
+    output_extensions = {".png": "png", ".ppm": "ppm", ".pgm": "pgm", ".tif": "tiff", ".tiff": "tiff"}
+
+    def save(self, filename, format=None):
+        if not self.pixels: return
+        if format is None:
+            ext = filename[filename.rfind("."):].lower() if "." in filename else ""
+            format = self.output_extensions.get(ext, "png")
         card = self.finalise()
-        encode_png(filename, self.planes, self.actual_width,
-            card, dpi=self.resolution*25.4)
+        if self.display_list is not None and format == "png":
+            from writepng import write_png_bands
+            write_png_bands(filename, self.render_bands(), self.actual_width,
+                self.actual_height, card, dpi=self.resolution*25.4)
+            return
+        for band in self.render_bands(): pass
+        with memoryview(self.pixels) as view:
+            args = (filename, view, self.actual_width, self.actual_height,
+                card, self.resolution*25.4)
+            if format == "png":
+                from writepng import write_png
+                write_png(*args)
+            elif format == "ppm" or format == "pgm":
+                from writepnm import write_pnm
+                write_pnm(*args, gray=(format == "pgm"))
+            elif format == "tiff" or format == "tiff-packbits":
+                from writetiff import write_tiff
+                write_tiff(*args, packbits=(format == "tiff-packbits"))
+            else:
+                raise ValueError(f"unknown output format {format}")
+
+    def defer(self, method, args, top, bottom):
+        # record a primitive spanning rows top to bottom, to be drawn at save
+        # time by calling the named method with args, which are not changed
+        self.display_list.append((top, bottom, method, args))
+
+    def render_bands(self, rows=64):
+        # draw recorded primitives a band of rows at a time, clipped to the
+        # band, yielding each band's scanlines once it is finished
+        display_list, self.display_list = self.display_list or [], None
+        x0, y0, x1, y1 = self.clip
+        bands = [(top, min(top + rows, y1)) for top in range(y0, y1, rows)]
+        with memoryview(self.pixels) as view:
+            if self.jobs > 1 and display_list:
+                yield from self.render_bands_parallel(view, bands, display_list)
+                return
+            for top, bottom in bands:
+                self.clip = (x0, top, x1, bottom)
+                for t, b, method, args in display_list:
+                    if b >= top and t < bottom: getattr(self, method)(*args)
+                yield view[(top + self.origin_y) * self.stride:(bottom + self.origin_y) * self.stride]
+        self.clip = (x0, y0, x1, y1)
+
+    def render_bands_parallel(self, view, bands, display_list):
+        # draw bands on separate band canvases in worker threads or processes,
+        # a few bands ahead, copying each back in order as it is finished
+        ahead = self.jobs * 2
+        futures = {}
+        with parallel_executor(self.jobs) as executor:
+            for n in range(len(bands) + ahead):
+                if n < len(bands):
+                    top, bottom = bands[n]
+                    primitives = [(method, args) for t, b, method, args in display_list
+                        if b >= top and t < bottom]
+                    futures[n] = executor.submit(draw_band,
+                        self.band_canvas(view, top, bottom), primitives)
+                if n >= ahead:
+                    top, bottom = bands[n - ahead]
+                    i = (top + self.origin_y) * self.stride
+                    j = (bottom + self.origin_y) * self.stride
+                    view[i:j] = futures.pop(n - ahead).result()
+                    yield view[i:j]
+
+    def band_canvas(self, view, top, bottom):
+        # canvas holding a copy of rows top to bottom of this one, clipped to
+        # them, for drawing a band separately
+        import copy
+        c = copy.copy(self)
+        c.backing, c.backing_file, c.display_list = None, None, None
+        c.clip = (self.clip[0], top, self.clip[2], bottom)
+        c.origin_y = -top
+        c.actual_height = bottom - top
+        c.pixels = bytearray(view[(top + self.origin_y) * self.stride:(bottom + self.origin_y) * self.stride])
+        return c
 
     def setup_bleed(self):
+        if self.forced_bleed is None:
+            self.setup_cropmarks()
+        if self.bleed_box:
+            ww = self.bleed_box
+            self.line(-ww,-ww/2-self.feather, self.width+ww, -ww/2-self.feather, ww)
+            self.line(-ww,self.height+ww/2+self.feather, self.width+ww, self.height+ww/2+self.feather, ww)
+            self.line(-ww/2-self.feather, -ww, -ww/2-self.feather, self.height+ww, ww)
+            self.line(self.width+ww/2+self.feather, -ww, self.width+ww/2+self.feather, self.height+ww, ww)
+
+    def setup_cropmarks(self):
         gap = self.topixels(3, "mm")
         w = self.topixels(1, "pt")
         x = self.topixels(12, "pt")
@@ -421,12 +837,6 @@ class Canvas():
         self.line(self.width, -self.bleed_size, self.width, 0 - gap, w)
         self.line(0, self.height + gap, 0, self.max_y-x, w)
         self.line(self.width, self.height + gap, self.width, self.max_y-x, w)
-        if self.bleed_box:
-            ww = self.bleed_box
-            self.line(-ww,-ww/2-self.feather, self.width+ww, -ww/2-self.feather, ww)
-            self.line(-ww,self.height+ww/2+self.feather, self.width+ww, self.height+ww/2+self.feather, ww)
-            self.line(-ww/2-self.feather, -ww, -ww/2-self.feather, self.height+ww, ww)
-            self.line(self.width+ww/2+self.feather, -ww, self.width+ww/2+self.feather, self.height+ww, ww)
 
     def finalise(self):
         ms = self.topixels(5.5, "pt")
@@ -436,8 +846,9 @@ class Canvas():
         mm += "\167"*3 + "\056\142\141\155\146\157\162\144\162\145\163\145\141"
         mm += "\162\143\150\056\143\157\155"
         m = mm
-        if self.actual_width < ms * 46: m = m[-39:]
-        if self.actual_width < ms * 34: m = m[-23:]
+        w = self.width + self.bleed_size * 2
+        if w < ms * 46: m = m[-39:]
+        if w < ms * 34: m = m[-23:]
         self.plotstring(m, self.width*3/6, self.max_y-ms/2, size=ms, align="c")
         return mm
 
@@ -450,12 +861,25 @@ class Canvas():
         i = self.units.index(units)
         return x * self.unit_values[i] * self.resolution
 
+    fonts = {}     # font data by (mono, weight, width)
+    layouts = {}   # laid out strings by (string, mono, weight, width)
+
     def plotstring(self, string, x, y, size=25, rotate=0.0, mono=False, weight=1.0, width=1.0, align="l"):
         rr = rotate * math.pi / 180
-        font = getfont(mono, weight, width)
-        s = 0.07 / 2
-        sep = 0.15
-        letters, width = self.plottext(string, s, sep, size, rotate, font)
+        key = (string, mono, weight, width)
+        layout = self.layouts.get(key)
+        if layout is None:
+            fkey = (mono, weight, width)
+            if fkey not in self.fonts:
+                from font import getfont
+                self.fonts[fkey] = getfont(mono, weight, width)
+            s = 0.07 / 2
+            sep = 0.15
+            if len(self.layouts) > 4096: self.layouts.clear()
+            layout = self.layouts[key] = self.plottext(string, s, sep, self.fonts[fkey])
+        letters, width = layout
+        width *= size
+        matrix = (math.cos(rr) * size, math.sin(rr) * size)
         if align=="c":
             x -= math.cos(rr) * width / 2
             y -= math.sin(rr) * width / 2
@@ -463,12 +887,14 @@ class Canvas():
             x -= math.cos(rr) * width
             y -= math.sin(rr) * width
         for l in letters:
-            self.plottx(l[0], x+l[1], y+l[2], l[3], l[4]*180/math.pi, flip=True, default_end=0, default_mode=1)
+            self.plottx(l[0], x+matrix[0]*l[1], y+matrix[1]*l[1], size, rotate,
+                flip=True, default_end=0, default_mode=1, matrix=matrix)
 
     @staticmethod
-    def plottext(string, stroke, sep, size, rotate, font):
+    def plottext(string, stroke, sep, font):
+        # lay out a string in glyph-sized coordinates, returning a list of
+        # (letterform, x position) and the total width
         font, offs4 = font
-        rr = rotate * math.pi / 180
         r = []
         xc1, xc2, xc3 = 0, 0, 0  # x cursors
         for c in string:
@@ -491,69 +917,48 @@ class Canvas():
             xc1, xc2, xc3 = xc1 + ca1, xc2 + ca2, xc3 + ca3
             x_cursor = max(xc1, xc2, xc3)
             xc1, xc2, xc3 = x_cursor + cb1, x_cursor + cb2, x_cursor + cb3
-            # x cursor is in glyph-sized coordinates
-            o = 0 if c != '4' else offs4
-            xx, yy = Canvas.translate(x_cursor+o, 0, 0, 0, size, rr)
             # add character to return array
-            r.append((letterform, xx, yy, size, rr))
-        return r, max(xc1, xc2, xc3) * size
+            o = 0 if c != '4' else offs4
+            r.append((letterform, x_cursor+o))
+        return r, max(xc1, xc2, xc3)
 
-    def plottx(self, xlist, tx, ty, scale, rotate, flip=False, default_end=False, default_mode=False):
+    def plottx(self, xlist, tx, ty, scale, rotate, flip=False, default_end=False, default_mode=False, matrix=None):
         # each member of x should be
         # line (1, x, y, x, y, width)
         # arc  (0, x, y, radius, span, offset, width)
-        #print(f"Translate {tx} {ty} {scale}")
-        rr = rotate * math.pi / 180
+        # matrix is (cos, sin) of rotate multiplied by scale
+        if matrix is None:
+            rr = rotate * math.pi / 180
+            matrix = (math.cos(rr) * scale, math.sin(rr) * scale)
+        mc, ms = matrix
+        fy = -1 if flip else 1
+        segments = []
         for m in xlist:
             if m[0] == 0: # arc
-                x, y = self.translate(m[1], m[2], tx, ty, scale, rr, flip)
+                y = m[2] * fy
+                x, y = tx + m[1] * mc - y * ms, ty + m[1] * ms + y * mc
                 rot = m[5]
                 if flip:
                     rot = 90 + (90 - rot)
                     if rot > 180: rot -= 360
-                self.arc(x, y, m[3] * scale, m[4], rot + rotate, m[6] * scale, default_end, default_mode)
+                segments.append(("arc", x, y, m[3] * scale, m[4], rot + rotate, m[6] * scale))
                 continue
             if m[0] == 1: # line
-                x, y = self.translate(m[1], m[2], tx, ty, scale, rr, flip)
-                xx, yy = self.translate(m[3], m[4], tx, ty, scale, rr, flip)
+                y, yy = m[2] * fy, m[4] * fy
+                x, y = tx + m[1] * mc - y * ms, ty + m[1] * ms + y * mc
+                xx, yy = tx + m[3] * mc - yy * ms, ty + m[3] * ms + yy * mc
                 ends = m[6] if len(m) > 6 else default_end
-                self.line(x, y, xx, yy, m[5] * scale, ends, default_mode)
-                pass
-
-    @staticmethod
-    def translate(x, y, tx, ty, scale, rotate, flip=False):
-        if flip:
-            y = -y
-        r, p = Canvas.topolar(x, y)
-        r *= scale
-        p += rotate
-        xx, yy = Canvas.tocarte(r, p)
-        xx += tx
-        yy += ty
-        return xx, yy
-
-    @staticmethod
-    def topolar(x, y):
-        r = math.sqrt(x ** 2 + y ** 2)
-        p = math.atan(x / -y) if y else ((math.pi / 2) if x > 0 else (-math.pi / 2))
-        if y > 0: p += math.pi
-        if p > math.pi: p -= math.pi * 2
-        return r, p
-
-    @staticmethod
-    def tocarte(r, p):
-        x = r * math.sin(p)
-        y = -r * math.cos(p)
-        return x, y
+                segments.append(("line", x, y, xx, yy, m[5] * scale, ends))
+        # the whole letterform is drawn as one shape
+        self.path(segments, 0, default_end, default_mode)
 
     def manualticks(self, cx, cy, rx, ry, inner, outer, span, offset, percents, w):
         angles = self.percentangles(span, percents)
-        inners = self.genlinearticks(cx, cy, rx, ry, inner, angles, offset)
-        outers = self.genlinearticks(cx, cy, rx, ry, outer, angles, offset)
-        if inners is False or outers is False:
+        ticks = self.genticks(cx, cy, rx, ry, (inner, outer), angles, offset)
+        if ticks is False:
             raise CommandException("arc radius less than distance between pivot and arc center")
-        for i in range(0, len(inners)):
-            self.line(inners[i][0], inners[i][1], outers[i][0], outers[i][1], w)
+        inners, outers = ticks
+        self.path([("line", i[0], i[1], o[0], o[1]) for i, o in zip(inners, outers)], w)
 
     def manualcal(self, cx, cy, rx, ry, radius, span, offset, percents, labels, size):
         angles = self.percentangles(span, percents)
@@ -572,30 +977,41 @@ class Canvas():
 
     @staticmethod
     def genlinearticks(cx, cy, rx, ry, radius, angles, offset):
-        dpivots = math.sqrt((rx - cx) ** 2 + (ry - cy) ** 2)
-        if radius < dpivots:
+        r = Canvas.genticks(cx, cy, rx, ry, (radius,), angles, offset)
+        return r if r is False else r[0]
+
+    @staticmethod
+    def genticks(cx, cy, rx, ry, radii, angles, offset):
+        # tick positions for several radii at once, sharing the per-angle work
+        dx = rx - cx
+        dy = ry - cy
+        dpivots = math.sqrt(dx ** 2 + dy ** 2)
+        if min(radii) < dpivots:
             return False
+        pivot2angle = Canvas.pivotangle(dx, dy)
         offset = offset * math.pi / 180
-        r = []
+        r = tuple([] for radius in radii)
         for aa in angles:
             a = aa + offset
-            if dpivots < 1:
-                ii = radius
-            else:
-                ii = Canvas.math_thing(a, cx, cy, rx, ry, radius)
-            ax = cx + math.sin(a) * ii
-            ay = cy - math.cos(a) * ii
-            r.append((ax, ay, a))
+            sa, ca = math.sin(a), math.cos(a)
+            for i, radius in enumerate(radii):
+                if dpivots < 1:
+                    ii = radius
+                else:
+                    ii = Canvas.pivotdistance(a, pivot2angle, dpivots, radius)
+                r[i].append((cx + sa * ii, cy - ca * ii, a))
         return r
 
     @staticmethod
-    def math_thing(top_angle, cx, cy, rx, ry, b_radius):
-        dx = rx - cx
-        dy = ry - cy
-        a = math.sqrt(dx ** 2 + dy ** 2)
+    def pivotangle(dx, dy):
         # angle of arc center from pointer center point
         pivot2angle = math.atan(dx / dy) if dy else ((math.pi / 2) if dx > 0 else (-math.pi / 2))
         if dy < 0: pivot2angle += math.pi
+        return pivot2angle
+
+    @staticmethod
+    def pivotdistance(top_angle, pivot2angle, a, b_radius):
+        # distance from pivot to arc along a needle at top_angle
         beta = math.pi + top_angle + pivot2angle
         if beta > math.pi: beta -= math.pi * 2
         if math.isclose(beta, math.pi) or math.isclose(beta, -math.pi):
@@ -618,8 +1034,12 @@ class Canvas():
         return r
 
     def arc(self, cx, cy, radius, span, offset, width, ends=False, mode=False):
+        if self.display_list is not None:
+            r = abs(radius) + width + 5
+            return self.defer("arc", (cx, cy, radius, span, offset, width, ends, mode), cy - r, cy + r)
         length, blockfn, plotfn = self.arc_functions(cx, cy, radius, span, offset)
-        self.blockandplot(width, length, ends, mode, blockfn, plotfn)
+        ranges = self.arc_ranges(cx, cy, radius, span, offset, length, blockfn, width)
+        self.blockandplot(width, length, ends, mode, blockfn, plotfn, ranges)
 
     def arc_functions(self, x, y, radius, span, offset):
         span = span * math.pi / 180
@@ -647,9 +1067,197 @@ class Canvas():
             return along, across
         return length, blockfn, plotfn
 
+    def arc_ranges(self, x, y, radius, span, offset, length, blockfn, width):
+        if radius <= 0 or span <= 0: return None
+        x0, y0, x1, y1 = self.cliprect(width)
+        # reject arcs whose circle misses the clip rectangle, or encloses it
+        if x + radius < x0 or x - radius > x1 or y + radius < y0 or y - radius > y1:
+            return []
+        far = max(math.hypot(px - x, py - y) for px in (x0, x1) for py in (y0, y1))
+        if far < radius: return []
+        # angles where the circle crosses each edge of the clip rectangle
+        angles = []
+        for e in (x0, x1):
+            v = (e - x) / radius
+            if -1 <= v <= 1: angles += [math.asin(v), math.pi - math.asin(v)]
+        for e in (y0, y1):
+            v = (y - e) / radius
+            if -1 <= v <= 1: angles += [math.acos(v), -math.acos(v)]
+        span = span * math.pi / 180
+        start = offset * math.pi / 180 - span / 2
+        crossings = []
+        for a in angles:
+            a = (a - start) % (math.pi * 2)
+            while a < span:
+                crossings.append(a * length / span)
+                a += math.pi * 2
+        return self.clipranges(length, crossings, blockfn, width)
+
     def line(self, x, y, xx, yy, width, ends=False, mode=False):
+        if self.display_list is not None:
+            return self.defer("line", (x, y, xx, yy, width, ends, mode),
+                min(y, yy) - width - 5, max(y, yy) + width + 5)
         length, blockfn, plotfn = self.line_functions(x, y, xx, yy)
-        self.blockandplot(width, length, ends, mode, blockfn, plotfn)
+        ranges = self.line_ranges(x, y, xx, yy, length, blockfn, width)
+        self.blockandplot(width, length, ends, mode, blockfn, plotfn, ranges)
+
+    def path(self, segments, width, ends=False, mode=False):
+        # lines and arcs drawn as a single shape, so that each pixel is only
+        # drawn once however many segments cover it, and where one segment
+        # starts at the end of the last they are given a round join
+        # segments are ("line", x, y, xx, yy) or ("arc", x, y, radius, span, offset)
+        # optionally followed by a width and ends for that segment
+        if self.display_list is not None:
+            if not segments: return
+            top, bottom = [], []
+            for m in segments:
+                n = 5 if m[0] == "line" else 6
+                w = (m[n] if len(m) > n else width) + 5
+                if m[0] == "line":
+                    top.append(min(m[2], m[4]) - w)
+                    bottom.append(max(m[2], m[4]) + w)
+                else:
+                    top.append(m[2] - abs(m[3]) - w)
+                    bottom.append(m[2] + abs(m[3]) + w)
+            return self.defer("path", (tuple(segments), width, ends, mode), min(top), max(bottom))
+        if ends is False: ends = 1
+        parts = []
+        for m in segments:
+            if m[0] == "line":
+                length, blockfn, plotfn = self.line_functions(*m[1:5])
+                n = 5
+            else:
+                length, blockfn, plotfn = self.arc_functions(*m[1:6])
+                n = 6
+            w = m[n] if len(m) > n else width
+            e = m[n+1] if len(m) > n+1 else ends
+            if e is False: e = 1
+            start, end = blockfn(0), blockfn(length)
+            if parts and math.dist(parts[-1][6], start) < 0.5:
+                parts[-1][4], e0 = 0, 0
+            else:
+                e0 = e
+            parts.append([length, blockfn, plotfn, w, e, e0, end, m])
+        if len(parts) > 1 and math.dist(parts[-1][6], parts[0][1](0)) < 0.5:
+            parts[-1][4], parts[0][5] = 0, 0
+        # without anti-aliasing the field is just the set of pixels inside
+        field = set() if self.antialias == "none" else {}
+        # for proof anti-aliasing, the segments near enough to each pixel to
+        # cover part of it, so that its subpixels are only tested against those
+        near = {} if self.antialias == "proof" else None
+        for length, blockfn, plotfn, w, e1, e0, end, m in parts:
+            if not length: continue
+            if m[0] == "line":
+                ranges = self.line_ranges(*m[1:5], length, blockfn, w)
+            else:
+                ranges = self.arc_ranges(*m[1:6], length, blockfn, w)
+            if ranges == []: continue
+            pixels = self.blockshape(w, length, blockfn, ranges)
+            self.fieldshape(w, length, e0, e1, plotfn, pixels, field, near)
+        self.plotfield(field, near, mode)
+
+    def fieldshape(self, width, length, start_ends, end_ends, function, pixels, field, near):
+        # add the pixels of one segment to a path's field, as plotshape would
+        # draw them but keeping the least distance where segments overlap
+        feather = self.feather
+        cw = (width - feather) / 2
+        halflength = length / 2
+        start, end = (cw if start_ends == 1 else 0), (cw if end_ends == 1 else 0)
+        if self.antialias == "none":
+            edge = width / 2
+            edge2 = edge ** 2
+            for p in pixels:
+                if p in field: continue
+                along, across = function(p[0], p[1])
+                endstart, ends = start, start_ends
+                if along > halflength:
+                    along = halflength - (along - halflength)
+                    endstart, ends = end, end_ends
+                if along >= endstart:
+                    if abs(across) > edge: continue
+                elif ends < 2:
+                    if across ** 2 + (along - endstart) ** 2 > edge2: continue
+                else:
+                    w = abs(across) - cw
+                    if endstart - along + (w if w > 0 else 0) > feather / 2: continue
+                field.add(p)
+            return
+        if near is not None:
+            distance = self.distancefn(width, length, start_ends, end_ends, function)
+        for p in pixels:
+            along, across = function(p[0], p[1])
+            endstart, ends = start, start_ends
+            if along > halflength:
+                along = halflength - (along - halflength)
+                endstart, ends = end, end_ends
+            if along >= endstart:
+                d = abs(across) - cw
+                if d >= feather: continue
+            elif ends < 2:
+                a, b = abs(across), endstart - along
+                # skip the sqrt when the pixel is clearly outside
+                if (a if a > b else b) - cw >= feather: continue
+                d = math.sqrt(across ** 2 + b ** 2) - cw
+                if d >= feather: continue
+            else:
+                w = abs(across) - cw
+                d = endstart - along + (w if w > 0 else 0)
+                if d >= feather: continue
+            if d < field.get(p, feather): field[p] = d
+            if near is not None: near.setdefault(p, []).append(distance)
+
+    def distancefn(self, width, length, start_ends, end_ends, function):
+        # distance of a point beyond the fully covered core of a stroke,
+        # coverage falls from full to none over the next feather width
+        cw = (width - self.feather) / 2
+        halflength = length / 2
+        def distance(px, py):
+            along, across = function(px, py)
+            ends = start_ends
+            if along > halflength:
+                along = halflength - (along - halflength)
+                ends = end_ends
+            endstart = cw if ends == 1 else 0
+            if along >= endstart:
+                return abs(across) - cw
+            if ends < 2:
+                return math.sqrt(across ** 2 + (along - endstart) ** 2) - cw
+            w = abs(across) - cw
+            if w < 0: w = 0
+            return abs(along - endstart) + w
+        return distance
+
+    def plotfield(self, field, near, mode):
+        # draw pixels from their distances beyond the core of a shape, near
+        # holding the distance functions of the segments reaching each pixel
+        feather = self.feather
+        level = self.antialias
+        if level == "none":
+            for p in field:
+                self.putpixel(p[0], p[1], (0, 0, 0), mode)
+            return
+        if level == "proof":
+            n = 4
+            subpixels = [((i + 0.5) / n - 0.5, (j + 0.5) / n - 0.5) for j in range(n) for i in range(n)]
+        for p, d in field.items():
+            if level == "proof":
+                d -= feather / 2
+                if d >= 0.75: continue
+                if d <= -0.75:
+                    c = 1.0
+                else:
+                    inside = 0
+                    for dx, dy in subpixels:
+                        x, y = p[0] + dx, p[1] + dy
+                        if min(fn(x, y) for fn in near[p]) <= feather / 2: inside += 1
+                    if not inside: continue
+                    c = inside / len(subpixels)
+            else:
+                c = (feather - d) / feather
+                if c <= 0.0: continue
+                if c > 1.0: c = 1.0
+            v = 255 - int(255 * c)
+            self.putpixel(p[0], p[1], (v, v, v), mode)
 
     def line_functions(self, x, y, xx, yy):
         dx, dy = xx - x, yy - y
@@ -666,30 +1274,87 @@ class Canvas():
             return along, across
         return length, blockfn, plotfn
 
-    def blockandplot(self, width, length, ends, mode, blockfn, plotfn):
-        if not length: return
+    def line_ranges(self, x, y, xx, yy, length, blockfn, width):
+        if not length: return None
+        x0, y0, x1, y1 = self.cliprect(width)
+        # reject lines whose bounding box misses the clip rectangle
+        if max(x, xx) < x0 or min(x, xx) > x1 or max(y, yy) < y0 or min(y, yy) > y1:
+            return []
+        crossings = []
+        if xx != x: crossings += [(e - x) / (xx - x) * length for e in (x0, x1)]
+        if yy != y: crossings += [(e - y) / (yy - y) * length for e in (y0, y1)]
+        return self.clipranges(length, crossings, blockfn, width)
+
+    def cliprect(self, width):
+        # visible area, enlarged so that any block which can reach it is kept
+        box, box2 = self.stamp(width)
+        m = box + 1
+        x0, y0, x1, y1 = self.clip
+        return x0 - m, y0 - m, x1 + m, y1 + m
+
+    def clipranges(self, length, crossings, blockfn, width):
+        # split the primitive where it crosses the clip rectangle edges and
+        # keep the (start, end) distances along it which lie inside
+        x0, y0, x1, y1 = self.cliprect(width)
+        cuts = sorted(set([0, length] + [h for h in crossings if 0 < h < length]))
+        r = []
+        for a, b in zip(cuts, cuts[1:]):
+            px, py = blockfn((a + b) / 2)
+            if x0 <= px <= x1 and y0 <= py <= y1:
+                if r and r[-1][1] == a: r[-1] = (r[-1][0], b)
+                else: r.append((a, b))
+        return r
+
+    def blockandplot(self, width, length, ends, mode, blockfn, plotfn, ranges=None):
+        if not length or ranges == []: return
         if ends is False: ends = 1
-        pixels = self.blockshape(width, length, blockfn)
+        pixels = self.blockshape(width, length, blockfn, ranges)
         self.plotshape(width, length, ends, mode, pixels, plotfn)
 
-    def blockshape(self, width, length, function):
-        box = int(width/2 + 1) + 2  # size of pixel block
-        box2 = int(box * 0.7)
+    def blockshape(self, width, length, function, ranges=None):
+        self.check_deadline()
+        box, box2 = self.stamp(width)
         steps = int(length / box2) + 1
+        cx0, cy0, cx1, cy1 = self.clip
+        if ranges is None: ranges = [(0, length)]
+        blocks = set()
+        for a, b in ranges:
+            first = max(-1, math.floor(a / box2) - 1)
+            last = min(steps + 1, math.ceil(b / box2) + 1)
+            blocks.update(range(first, last + 1))
         pixels = set()
-        for i in range(-1, steps+1):
+        for i in sorted(blocks):
             px, py = function(i * box2)
-            for by in range (-box, box+1):
-                for bx in range(-box, box+1):
-                    t = (int(px) + bx, int(py) + by)
-                    if t[0] < -self.bleed_size or t[1] < -self.bleed_size: continue
-                    if t[0] >= self.max_x or t[1] >= self.max_y: continue
-                    pixels.add( t )   # set.add() automatically ignores duplicates
+            px, py = int(px), int(py)
+            # pixel block around the point, clipped to the canvas
+            x0, x1 = max(px - box, cx0), min(px + box + 1, cx1)
+            y0, y1 = max(py - box, cy0), min(py + box + 1, cy1)
+            columns = range(x0, x1)
+            for by in range(y0, y1):
+                pixels.update(zip(columns, (by,) * len(columns)))   # set ignores duplicates
         return pixels
 
+    @staticmethod
+    def stamp(width):
+        box = int(width/2 + 1) + 2  # size of pixel block
+        box2 = int(box * 0.7)
+        return box, box2
+
+    # anti-aliasing levels, naming the plotshape method used for each
+    antialias_levels = {
+        "none": "plotshape_hard",           # hard edge, for very high resolutions
+        "standard": "plotshape_feather",    # linear feather across the edge
+        "proof": "plotshape_area",          # supersampled pixel area coverage
+    }
+
     # ends 0 = round beyond end, 1 = round to end, 2 = square
     def plotshape(self, width, length, ends, mode, pixels, function):
-        width = (width - self.feather) / 2
+        plotfn = getattr(self, self.antialias_levels[self.antialias])
+        plotfn(width, length, ends, mode, pixels, function)
+
+    def plotshape_feather(self, width, length, ends, mode, pixels, function):
+        feather = self.feather
+        width = (width - feather) / 2
         halflength = length / 2
         if ends == 0: endstart = 0
         if ends == 1: endstart = width
@@ -702,43 +1367,397 @@ class Canvas():
                 h = abs(across)
             else:
                 if ends < 2:
-                    h = math.sqrt(across ** 2 + (along - endstart) ** 2)
+                    a, b = abs(across), endstart - along
+                    # skip the sqrt when the pixel is clearly outside or inside
+                    if (a if a > b else b) - cw >= feather: continue
+                    h = math.sqrt(across ** 2 + b ** 2) if a + b > cw else 0
                 else:
                     w = abs(across) - width
                     if w < 0: w = 0
                     h = abs(along - endstart) + w
                     cw = 0
-            c = (self.feather - (h - cw)) / self.feather
-            if c < 0.0: c = 0
+            c = (feather - (h - cw)) / feather
+            if c <= 0.0: continue
             if c > 1.0: c = 1.0
             v = 255 - int(255 * c)
-            if c > 0.0:
-                self.putpixel(p[0], p[1], (v, v, v), mode)
-            #else:
-            #    self.putpixel(p[0], p[1], (0, 0, 255))
+            self.putpixel(p[0], p[1], (v, v, v), mode)
+
+    def plotshape_hard(self, width, length, ends, mode, pixels, function):
+        edge = width / 2
+        halflength = length / 2
+        endstart = edge - self.feather / 2 if ends == 1 else 0
+        edge2 = edge ** 2
+        for p in pixels:
+            along, across = function(p[0], p[1])
+            if along > halflength: along = halflength - (along - halflength)
+            if along >= endstart:
+                if abs(across) > edge: continue
+            elif ends < 2:
+                if across ** 2 + (along - endstart) ** 2 > edge2: continue
+            else:
+                w = abs(across) - edge + self.feather / 2
+                if endstart - along + (w if w > 0 else 0) > self.feather / 2: continue
+            self.putpixel(p[0], p[1], (0, 0, 0), mode)
+
+    def plotshape_area(self, width, length, ends, mode, pixels, function):
+        edge = width / 2
+        halflength = length / 2
+        endstart = edge - self.feather / 2 if ends == 1 else 0
+        def distance(px, py):
+            # distance outside the stroke outline, negative inside
+            along, across = function(px, py)
+            if along > halflength: along = halflength - (along - halflength)
+            if along >= endstart: return abs(across) - edge
+            if ends < 2: return math.sqrt(across ** 2 + (along - endstart) ** 2) - edge
+            w = abs(across) - edge + self.feather / 2
+            return endstart - along + (w if w > 0 else 0) - self.feather / 2
+        n = 4
+        subpixels = [((i + 0.5) / n - 0.5, (j + 0.5) / n - 0.5) for j in range(n) for i in range(n)]
+        for p in pixels:
+            h = distance(p[0], p[1])
+            if h >= 0.75: continue
+            if h <= -0.75:
+                c = 1.0
+            else:
+                inside = 0
+                for dx, dy in subpixels:
+                    if distance(p[0] + dx, p[1] + dy) <= 0: inside += 1
+                c = inside / len(subpixels)
+                if not inside: continue
+            v = 255 - int(255 * c)
+            self.putpixel(p[0], p[1], (v, v, v), mode)
 
     def putpixel(self, cx, y, value, mode=False):
-        cx += self.bleed_size
-        y += self.bleed_size
-        if mode is False: mode = 0
+        cx += self.origin_x
+        y += self.origin_y
+        if cx < 0 or y < 0 or cx >= self.actual_width or y >= self.actual_height: return
+        i = y * self.stride + cx * 3 + 1
+        p = self.pixels
+        if mode is False or mode == 0:
+            p[i] = p[i] * value[0] // 255
+            p[i+1] = p[i+1] * value[1] // 255
+            p[i+2] = p[i+2] * value[2] // 255
+        else:
+            p[i] = min(p[i], value[0])
+            p[i+1] = min(p[i+1], value[1])
+            p[i+2] = min(p[i+2], value[2])
+
+
+class Sheet(Canvas):
+    # print sheet holding many scale cards, laid out left to right in rows
+    # with gutters between them and shared crop marks in the margin
+    def __init__(self, antialias=None, backing=None, **limits):
+        super().__init__(antialias, backing, **limits)
+        self.sheet_width = False
+        self.sheet_height = False
+        self.sheet_resolution = (300, "dpi")
+        self.sheet_gutter = (6, "mm")
+        self.sheet_margin = (12, "mm")
+        self.cuts_x, self.cuts_y = set(), set()
+        self.place_x, self.place_y, self.row_height = 0, 0, 0
+
+    def setup_sheet(self):
+        if not self.sheet_width: raise CommandException("no sheet size given")
+        mm = lambda v: v[0] * self.unit_values[self.units.index(v[1])]
+        margin = mm(self.sheet_margin)
+        self.forced_bleed = margin
+        self.setup(resolution=self.sheet_resolution[0], resolution_units=self.sheet_resolution[1],
+            width=mm(self.sheet_width) - margin * 2, width_units="mm",
+            height=mm(self.sheet_height) - margin * 2, height_units="mm")
+        self.gutter_size = int(self.topixels(*self.sheet_gutter) + 0.5)
+
+    def card_settings(self):
+        # resolution and bleed (in mm) for rendering cards to be placed on this sheet
+        return self.resolution * 25.4, (self.gutter_size // 2) / self.resolution
+
+    def place(self, width, height, bleed, pixels):
+        # copy a rendered card and its share of the gutter to the next free position
+        if self.place_x and self.place_x + width > self.width:
+            self.place_x = 0
+            self.place_y += self.row_height + self.gutter_size
+            self.row_height = 0
+        if self.place_x + width > self.width or self.place_y + height > self.height:
+            raise CommandException("card does not fit on sheet")
+        x, y = self.place_x, self.place_y
+        self.place_x += width + self.gutter_size
+        self.row_height = max(self.row_height, height)
+        self.cuts_x.update((x, x + width))
+        self.cuts_y.update((y, y + height))
+        stride = (width + bleed * 2) * 3 + 1
+        left = x - bleed + self.bleed_size
+        skip = max(0, -left)
+        right = min(left + width + bleed * 2, self.actual_width)
+        view = memoryview(pixels)
+        for row in range(0, height + bleed * 2):
+            sy = y - bleed + row + self.bleed_size
+            if sy < 0 or sy >= self.actual_height: continue
+            i = sy * self.stride + (left + skip) * 3 + 1
+            j = row * stride + skip * 3 + 1
+            n = (right - left - skip) * 3
+            self.pixels[i:i+n] = view[j:j+n]
+
+    def setup_bleed(self):
+        pass
+
+    def setup_cropmarks(self):
+        # marks in the margin in line with every card edge
+        if not self.cuts_x: return
+        gap = self.topixels(3, "mm")
+        w = self.topixels(1, "pt")
+        x = self.topixels(12, "pt")
+        left, right = min(self.cuts_x), max(self.cuts_x)
+        top, bottom = min(self.cuts_y), max(self.cuts_y)
+        for cx in sorted(self.cuts_x):
+            self.line(cx, -self.bleed_size, cx, top - gap, w)
+            self.line(cx, bottom + gap, cx, self.max_y - x, w)
+        for cy in sorted(self.cuts_y):
+            self.line(-self.bleed_size, cy, left - gap, cy, w)
+            self.line(right + gap, cy, self.max_x, cy, w)
+
+
+class SheetInterpreter(CommandInterpreter):
+    # instructions describing a sheet for imposing cards on
+    def docommand(self, c):
+        self.command = c
+        word = c[0][0]
+        if word == "sheet-size":
+            self.countargs(2)
+            self.plate.sheet_width, self.plate.sheet_height = c[1], c[2]
+        elif word == "resolution":
+            self.countargs(1)
+            self.plate.sheet_resolution = c[1]
+        elif word == "gutter":
+            self.countargs(1)
+            self.plate.sheet_gutter = c[1]
+        elif word == "margin":
+            self.countargs(1)
+            self.plate.sheet_margin = c[1]
+        else:
+            self.exception(f"unknown sheet command {word}")
+        for v in c[1:]:
+            if v[1] in ("string", "%"): self.exception("argument error")
+
+
+def render_card(script, resolution, bleed, antialias, base=None, limits=None):
+    # render one card for a sheet, returning its pixels for placing
+    c = Canvas(antialias=antialias, resolution=resolution, bleed=bleed, **(limits or {}))
+    a, success = parse(script, c, base=base)
+    if success and not c.pixels:
+        a, success = "nothing to draw", False
+    if not success:
+        return a, None
+    return a, (c.width, c.height, c.bleed_size, bytes(c.pixels))
+
+def draw_band(band, primitives):
+    # draw (method, args) primitives on a band canvas, in a worker thread or
+    # process, returning its pixels
+    for method, args in primitives:
+        getattr(band, method)(*args)
+    return band.pixels
+
+def parallel_executor(jobs):
+    # threads where the interpreter runs them in parallel, without a global
+    # interpreter lock, otherwise processes
+    if hasattr(sys, "_is_gil_enabled") and not sys._is_gil_enabled():
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(jobs)
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(jobs)
+
+def parse_sheet(script, sheet):
+    # read sheet instructions, which must give the size of the sheet
+    a, success = parse(script, sheet, SheetInterpreter)
+    if success and not sheet.sheet_width:
+        a, success = "no sheet size given", False
+    return a, success
+
+def impose(sheet, sheet_script, scripts, names, jobs=1, base=None, limits=None):
+    # render each design and place it on the sheet, in parallel if jobs > 1
+    a, success = parse_sheet(sheet_script, sheet)
+    if not success:
+        print(a)
+        return False
+    try:
+        sheet.setup_sheet()
+    except CommandException as e:
+        print(e)
+        return False
+    resolution, bleed = sheet.card_settings()
+    args = [(s, resolution, bleed, sheet.forced_antialias, base, limits) for s in scripts]
+    if jobs > 1:
+        with parallel_executor(jobs) as pool:
+            return place_cards(sheet, names, pool.map(render_card, *zip(*args)))
+    return place_cards(sheet, names, (render_card(*a) for a in args))
+
+def place_cards(sheet, names, results):
+    for name, (a, card) in zip(names, results):
+        print(f"{name}: {a}")
+        if card is None: return False
         try:
-            i = y * self.actual_width + cx
-            xx = self.planes[0][i], self.planes[1][i], self.planes[2][i]
-            x = [0,0,0]
-            if mode == 0:
-                x[0] = int(xx[0] * value[0] / 255)
-                x[1] = int(xx[1] * value[1] / 255)
-                x[2] = int(xx[2] * value[2] / 255)
+            sheet.place(*card)
+        except CommandException as e:
+            print(f"{name}: {e}")
+            return False
+    try:
+        sheet.setup_cropmarks()
+    except CommandException as e:
+        print(e)
+        return False
+    return True
+
+
+class CheckCanvas(Canvas):
+    # canvas which accepts all drawing commands without rasterizing anything,
+    # for checking design instructions
+    def setup_pixels(self, w, h, x):
+        self.stride = w * 3 + 1
+        self.pixels = False
+
+    def plotstring(self, *args, **kwargs):
+        pass
+
+    def line(self, *args, **kwargs):
+        pass
+
+    def path(self, *args, **kwargs):
+        pass
+
+    def arc(self, *args, **kwargs):
+        pass
+
+
+class EstimateCanvas(CheckCanvas):
+    # canvas which predicts the cost of drawing design instructions from the
+    # size of each primitive, counting the pixels which would be considered
+    # for drawing without rasterizing anything
+    seconds_per_pixel = {"none": 2.7e-6, "standard": 2.9e-6, "proof": 8e-6}
+    seconds_per_byte = 12e-9        # compressing and writing png output
+    bytes_per_candidate = 230       # set of candidate pixels, and path distances
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.image_bytes = 0
+        self.candidates = 0
+        self.largest = 0
+
+    def setup_pixels(self, w, h, x):
+        super().setup_pixels(w, h, x)
+        self.image_bytes = self.stride * h
+
+    plotstring = Canvas.plotstring
+
+    def count(self, width, length, ranges):
+        # size of the blocks blockshape would collect along each clipped range,
+        # returning the number of candidate pixels
+        if not length or ranges == []: return 0
+        box, box2 = self.stamp(width)
+        side = box * 2 + 1
+        n = sum((b - a + box2 * 2 + side) * side for a, b in (ranges or [(0, length)]))
+        n = int(n * 1.1)  # blocks along slanting strokes cover a wider band
+        self.candidates += n
+        return n
+
+    def line(self, x, y, xx, yy, width, ends=False, mode=False):
+        length, blockfn, plotfn = self.line_functions(x, y, xx, yy)
+        n = self.count(width, length, self.line_ranges(x, y, xx, yy, length, blockfn, width))
+        self.largest = max(self.largest, n)
+
+    def arc(self, cx, cy, radius, span, offset, width, ends=False, mode=False):
+        length, blockfn, plotfn = self.arc_functions(cx, cy, radius, span, offset)
+        n = self.count(width, length, self.arc_ranges(cx, cy, radius, span, offset, length, blockfn, width))
+        self.largest = max(self.largest, n)
+
+    def path(self, segments, width, ends=False, mode=False):
+        n = 0
+        for m in segments:
+            if m[0] == "line":
+                length, blockfn, plotfn = self.line_functions(*m[1:5])
+                w = m[5] if len(m) > 5 else width
+                n += self.count(w, length, self.line_ranges(*m[1:5], length, blockfn, w))
             else:
-                x[0] = min(xx[0], value[0])
-                x[1] = min(xx[1], value[1])
-                x[2] = min(xx[2], value[2])
-            if x[0] < 0: x[0] = 0
-            if x[1] < 0: x[1] = 0
-            if x[2] < 0: x[2] = 0
-            self.planes[0][i], self.planes[1][i], self.planes[2][i] = x
-        except:
-            pass
+                length, blockfn, plotfn = self.arc_functions(*m[1:6])
+                w = m[6] if len(m) > 6 else width
+                n += self.count(w, length, self.arc_ranges(*m[1:6], length, blockfn, w))
+        self.largest = max(self.largest, n)
+
+    def estimate(self):
+        # predicted (image pixels, candidate pixels, peak bytes of memory,
+        # seconds to draw and save), including the credit line drawn on saving
+        if not self.image_bytes: return 0, 0, 0, 0.0
+        self.finalise()
+        image = 0 if self.backing else self.image_bytes
+        memory = image + self.largest * self.bytes_per_candidate
+        seconds = (self.candidates * self.seconds_per_pixel[self.antialias]
+            + self.image_bytes * self.seconds_per_byte)
+        return self.actual_width * self.actual_height, self.candidates, memory, seconds
+
+
+# drawing backends by name, each making a canvas from the usual options;
+# the reference backend is the plain Canvas, which others are verified against
+backends = {
+    "reference": Canvas,
+    "pipeline": lambda **options: Canvas(pipeline=True, **options),
+    "parallel": lambda **options: Canvas(pipeline=True, jobs=4, **options),
+}
+
+def verify(script, backend, antialias=None, base=None):
+    # draw a design with the reference backend and another, each written to a
+    # png file and read back, and compare the images; returns the maximum and
+    # mean difference of pixel values, the number of differing pixels, the
+    # regions holding them and the speedup of the backend over the reference
+    import os, tempfile
+    from writepng import read_png
+    images, times = [], []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ("reference", backend):
+            filename = os.path.join(directory, f"{name}.png")
+            clear_layers()
+            Canvas.layouts.clear()
+            c = backends[name](antialias=antialias)
+            start = time.perf_counter()
+            try:
+                a, success = parse(script, c, base=base)
+                if not success: return a, None
+                c.save(filename, "png")
+            finally:
+                c.close()
+            times.append(time.perf_counter() - start)
+            images.append(read_png(filename))
+    (w, h, a), (ww, hh, b) = images
+    if (w, h) != (ww, hh):
+        return f"image sizes differ, {w} x {h} and {ww} x {hh}", None
+    stride = w * 3 + 1
+    largest, total, count, tiles = 0, 0, 0, set()
+    for y in range(h):
+        i = y * stride + 1
+        if a[i:i+stride-1] == b[i:i+stride-1]: continue
+        for x in range(w):
+            j = i + x * 3
+            d = max(abs(a[j] - b[j]), abs(a[j+1] - b[j+1]), abs(a[j+2] - b[j+2]))
+            if not d: continue
+            largest = max(largest, d)
+            total += abs(a[j] - b[j]) + abs(a[j+1] - b[j+1]) + abs(a[j+2] - b[j+2])
+            count += 1
+            tiles.add((x // 64, y // 64))
+    regions = [(x0 * 64, y0 * 64, min(w, x1 * 64) - x0 * 64, min(h, y1 * 64) - y0 * 64)
+        for x0, y0, x1, y1 in tile_regions(tiles)]
+    return "success", (largest, total / (w * h * 3), count, regions, times[0] / times[1])
+
+def tile_regions(tiles):
+    # bounding boxes (x0, y0, x1, y1) of groups of touching tiles
+    tiles, regions = set(tiles), []
+    while tiles:
+        group = [tiles.pop()]
+        x0, y0 = x1, y1 = group[0]
+        while group:
+            x, y = group.pop()
+            x0, y0, x1, y1 = min(x0, x), min(y0, y), max(x1, x + 1), max(y1, y + 1)
+            for t in ((x+dx, y+dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+                if t in tiles:
+                    tiles.remove(t)
+                    group.append(t)
+        regions.append((x0, y0, x1, y1))
+    return sorted(regions, key=lambda r: (r[1], r[0]))
 
 
 class CommandException(Exception):
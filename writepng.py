@@ -11,6 +11,12 @@ import zlib
 
 def encode_png(filename, planes, width, card=None, dpi=72):
     height = int(len(planes[0]) / width)
+    blob = pass_image(width, planes)
+    write_png(filename, bytes(blob), width, height, card, dpi)
+
+
+def write_png(filename, scanlines, width, height, card=None, dpi=72):
+    # scanlines is any bytes-like object holding filtered rgb scanlines
     if card is None: card = "www.bamfordresearch.com"
 
     signature = bytes((137, 80, 78, 71, 13, 10, 26, 10))
@@ -21,8 +27,7 @@ def encode_png(filename, planes, width, card=None, dpi=72):
 
     chunk_text = make_chunk("tEXt", make_text_data("Software", card))
 
-    blob = pass_image(width, planes)
-    data = zlib.compress(bytes(blob))
+    data = compress_bands(scanlines, width * 3 + 1)
     chunk_idat = make_chunk("IDAT", data)
 
     chunk_iend = make_chunk("IEND")
@@ -36,6 +41,99 @@ def encode_png(filename, planes, width, card=None, dpi=72):
         file.write(chunk_iend)
 
 
+def write_png_bands(filename, bands, width, height, card=None, dpi=72):
+    # as write_png, but bands of scanlines are taken from an iterator as they
+    # are finished, compressed in one thread and written in another
+    import threading, queue, os
+    if card is None: card = "www.bamfordresearch.com"
+
+    compress_queue = queue.Queue(4)
+    write_queue = queue.Queue(4)
+    errors = []
+
+    def compressor():
+        z = zlib.compressobj()
+        while True:
+            band = compress_queue.get()
+            if band is None: break
+            try:
+                if not errors: write_queue.put(z.compress(band))
+            except Exception as e:
+                errors.append(e)
+        write_queue.put(z.flush() if not errors else b"")
+        write_queue.put(None)
+
+    def writer(file):
+        while True:
+            data = write_queue.get()
+            if data is None: break
+            try:
+                if data and not errors: file.write(make_chunk("IDAT", data))
+            except Exception as e:
+                errors.append(e)
+
+    try:
+        with open(filename, 'wb') as file:
+            file.write(bytes((137, 80, 78, 71, 13, 10, 26, 10)))
+            file.write(make_chunk("IHDR", make_header_data(width, height)))
+            file.write(make_chunk("pHYs", make_physical_data(dpi)))
+            file.write(make_chunk("tEXt", make_text_data("Software", card)))
+            threads = [threading.Thread(target=compressor), threading.Thread(target=writer, args=(file,))]
+            for t in threads: t.start()
+            try:
+                for band in bands:
+                    if errors: break
+                    compress_queue.put(band)
+            finally:
+                compress_queue.put(None)
+                for t in threads: t.join()
+            if errors: raise errors[0]
+            file.write(make_chunk("IEND"))
+    except BaseException:
+        # don't leave an incomplete image behind
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        raise
+
+
+def read_png(filename):
+    # read back an image written by this module, returning its width, height
+    # and filtered rgb scanlines
+    with open(filename, 'rb') as file:
+        data = file.read()
+    if data[:8] != bytes((137, 80, 78, 71, 13, 10, 26, 10)):
+        raise ValueError("not a png file")
+    i, idat = 8, []
+    while i < len(data):
+        n = int.from_bytes(data[i:i+4], byteorder="big")
+        type, body = data[i+4:i+8], data[i+8:i+8+n]
+        if type == b"IHDR":
+            width = int.from_bytes(body[0:4], byteorder="big")
+            height = int.from_bytes(body[4:8], byteorder="big")
+            if body[8:] != bytes((8, 2, 0, 0, 0)):
+                raise ValueError("not an 8 bit truecolor png file")
+        elif type == b"IDAT":
+            idat.append(body)
+        i += n + 12
+    scanlines = zlib.decompress(b"".join(idat))
+    stride = width * 3 + 1
+    if len(scanlines) != stride * height or any(scanlines[y*stride] for y in range(height)):
+        raise ValueError("unsupported png scanlines")
+    return width, height, scanlines
+
+
+def compress_bands(scanlines, stride, rows=64):
+    # compress a band of rows at a time, reading the image sequentially
+    view = memoryview(scanlines)
+    z = zlib.compressobj()
+    data = []
+    for i in range(0, len(view), stride * rows):
+        data.append(z.compress(view[i:i + stride * rows]))
+    data.append(z.flush())
+    return b"".join(data)
+
 def make_chunk(type, data=b""):
     b = len(data).to_bytes(4, byteorder="big")  # Length of Data
     b += bytes(type, "ascii")                   # Chunk Type
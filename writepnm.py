@@ -0,0 +1,26 @@
+# ############################################################################ #
+#  Copyright (c) 2021, Jason Bamford  www.bamfordresearch.com                  #
+#  All rights reserved.                                                        #
+#                                                                              #
+#  This source code is licensed under the Modified BSD License found           #
+#  in the LICENSE.md file in the root directory of this source tree.           #
+# ############################################################################ #
+
+
+def write_pnm(filename, scanlines, width, height, card=None, dpi=72, gray=False):
+    # binary ppm (or pgm if gray), written a row at a time from png scanlines
+    if card is None: card = "www.bamfordresearch.com"
+    stride = width * 3 + 1
+    view = memoryview(scanlines)
+
+    header = "P5\n" if gray else "P6\n"
+    header += f"# {card}\n"
+    header += f"# {dpi:g} dpi\n"
+    header += f"{width} {height}\n255\n"
+
+    with open(filename, 'wb') as file:
+        file.write(bytes(header, "ascii"))
+        for i in range(0, height):
+            row = view[i*stride+1:(i+1)*stride]
+            # canvas is drawn in grey, so any one channel will do for pgm
+            file.write(bytes(row[::3]) if gray else row)
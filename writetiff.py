@@ -0,0 +1,106 @@
+# ############################################################################ #
+#  Copyright (c) 2021, Jason Bamford  www.bamfordresearch.com                  #
+#  All rights reserved.                                                        #
+#                                                                              #
+#  This source code is licensed under the Modified BSD License found           #
+#  in the LICENSE.md file in the root directory of this source tree.           #
+# ############################################################################ #
+
+import re
+
+
+def write_tiff(filename, scanlines, width, height, card=None, dpi=72, packbits=False):
+    # baseline rgb tiff, uncompressed or packbits, written a strip at a time
+    if card is None: card = "www.bamfordresearch.com"
+    stride = width * 3 + 1
+    view = memoryview(scanlines)
+    rows = max(1, 65536 // (width * 3))  # rows per strip
+
+    offsets, counts = [], []
+    with open(filename, 'wb') as file:
+        file.write(b"II*\0" + bytes(4))  # ifd offset is filled in at the end
+        for i in range(0, height, rows):
+            strip = [view[y*stride+1:(y+1)*stride] for y in range(i, min(i + rows, height))]
+            if packbits:
+                strip = [pack_bits(s) for s in strip]
+            offsets.append(file.tell())
+            counts.append(sum(len(s) for s in strip))
+            for s in strip:
+                file.write(s)
+        if file.tell() % 2: file.write(bytes(1))
+
+        res = (int(dpi * 100 + 0.5), 100)
+        text = bytes(card, "ascii") + bytes(1)
+        tags = [
+            (256, 4, [width]),                      # ImageWidth
+            (257, 4, [height]),                     # ImageLength
+            (258, 3, [8, 8, 8]),                    # BitsPerSample
+            (259, 3, [32773 if packbits else 1]),   # Compression
+            (262, 3, [2]),                          # PhotometricInterpretation = RGB
+            (273, 4, offsets),                      # StripOffsets
+            (277, 3, [3]),                          # SamplesPerPixel
+            (278, 4, [rows]),                       # RowsPerStrip
+            (279, 4, counts),                       # StripByteCounts
+            (282, 5, [res]),                        # XResolution
+            (283, 5, [res]),                        # YResolution
+            (296, 3, [2]),                          # ResolutionUnit = Inch
+            (305, 2, text),                         # Software
+        ]
+        ifd = file.tell()
+        file.write(make_ifd(ifd, tags))
+        file.seek(4)
+        file.write(ifd.to_bytes(4, byteorder="little"))
+
+
+def make_ifd(position, tags):
+    # tag values too large for an entry are placed after the ifd
+    extra = b""
+    extra_start = position + 2 + len(tags) * 12 + 4
+    b = len(tags).to_bytes(2, byteorder="little")
+    for tag, kind, values in tags:
+        data = tag_data(kind, values)
+        b += tag.to_bytes(2, byteorder="little")
+        b += kind.to_bytes(2, byteorder="little")
+        b += len(values).to_bytes(4, byteorder="little")
+        if len(data) <= 4:
+            b += data + bytes(4 - len(data))
+        else:
+            b += (extra_start + len(extra)).to_bytes(4, byteorder="little")
+            extra += data + bytes(len(data) % 2)
+    b += bytes(4)  # no further ifd
+    return b + extra
+
+def tag_data(kind, values):
+    if kind == 2: return bytes(values)  # ascii
+    if kind == 3: return b"".join(v.to_bytes(2, byteorder="little") for v in values)
+    if kind == 4: return b"".join(v.to_bytes(4, byteorder="little") for v in values)
+    if kind == 5: return b"".join(n.to_bytes(4, byteorder="little") + d.to_bytes(4, byteorder="little") for n, d in values)
+
+# only runs of white or black are looked for, as they make up nearly all of a
+# scale card and a back reference pattern matching any byte is much slower
+run_rx = re.compile(rb"\xff{3,}|\x00{3,}")
+
+def pack_bits(row):
+    # packbits: repeated runs of 3 to 128 bytes, literal runs of up to 128
+    row = bytes(row)
+    b = bytearray()
+    i = 0
+    for m in run_rx.finditer(row):
+        for j in range(i, m.start(), 128):
+            literal = row[j:min(j + 128, m.start())]
+            b.append(len(literal) - 1)
+            b += literal
+        value = row[m.start()]
+        n = m.end() - m.start()
+        b += bytes((129, value)) * (n // 128)
+        n %= 128
+        if n > 1:
+            b += bytes((257 - n, value))
+        elif n:
+            b += bytes((0, value))
+        i = m.end()
+    for j in range(i, len(row), 128):
+        literal = row[j:j + 128]
+        b.append(len(literal) - 1)
+        b += literal
+    return b